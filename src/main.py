@@ -1,16 +1,25 @@
 import os
 import json
-import io
+import asyncio
+import gzip
+import hashlib
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from xml.etree import ElementTree
 from datetime import datetime
 from typing import List, Optional
 
 from fastapi import FastAPI, File, UploadFile, Request, HTTPException, status
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles # Although we use CDN, good practice
+import orjson
+from cachetools import TTLCache
 from google.cloud import firestore
 import google.generativeai as genai
-from pypdf import PdfReader # For PDF text extraction
-from docx import Document as DocxDocument # For DOCX text extraction
+import fitz # PyMuPDF, for PDF text extraction
 
 # --- Environment Configuration ---
 # Ensure GEMINI_API_KEY is set in your Cloud Run environment variables
@@ -26,57 +35,373 @@ genai.configure(api_key=GEMINI_API_KEY)
 GEMINI_MODEL_FLASH = 'gemini-1.5-flash' # Prioritizing Flash for cost/speed
 LLM_MODEL = genai.GenerativeModel(GEMINI_MODEL_FLASH)
 
+# Static part of the summarization prompt. Explicit context caching is not
+# worth it here: Gemini 1.5 Flash caches only >=32,768 token prefixes and the
+# instructions are ~60 tokens, so they are simply prepended to each request.
+SUMMARY_INSTRUCTIONS = (
+    "Вие сте експерт по корпоративен анализ на документи. "
+    "Моля, резюмирайте следния документ на български език. "
+    "Обобщението трябва да е кратко, стегнато и да улавя основните точки. "
+    "Използвайте максимум 200 думи и форматирайте като списък с точки, ако е приложимо:"
+)
+
+class DynamicBatcher:
+    """Коалесцира конкурентни Gemini заявки в малки партиди.
+
+    Заявките, натрупани в прозорец от `max_delay` секунди (до
+    `max_batch_size` на партида), се изстрелват заедно с asyncio.gather.
+    Докато всяка заявка си остава отделно HTTP извикване, прозорецът не
+    бива да задържа нищо — вж. коментара при GEMINI_BATCHER.
+    """
+
+    def __init__(self, max_batch_size: int = 8, max_delay: float = 0.1):
+        self._max_batch_size = max_batch_size
+        self._max_delay = max_delay
+        self._pending = []  # list of (coroutine factory, future)
+        self._timer = None
+
+    async def submit(self, coro_factory):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((coro_factory, future))
+        if len(self._pending) >= self._max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._max_delay, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self, batch):
+        results = await asyncio.gather(
+            *(factory() for factory, _ in batch), return_exceptions=True
+        )
+        for (_, future), result in zip(batch, results):
+            if future.cancelled():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+# max_delay=0 = flush на следващия цикъл на event loop-а: коалесцират се само
+# заявки, подадени в същия tick, без да се добавя чакане. По-голям прозорец
+# има смисъл чак когато партидата стане едно реално batch извикване към
+# сървъра, а не N отделни HTTP заявки.
+GEMINI_BATCHER = DynamicBatcher(max_batch_size=8, max_delay=0.0)
+
 # Initialize Firestore DB client
-# In Cloud Run, this will automatically pick up credentials from the service account
-db = firestore.Client()
+# In Cloud Run, this will automatically pick up credentials from the service account.
+# Единственият AsyncClient (един преизползван gRPC канал) обслужва всички
+# операции — синхронният клиент в async handler-и струва по една нишка на
+# операция и блокира event loop-а.
+db = firestore.AsyncClient()
 DOCUMENTS_COLLECTION = 'documents'
+# Cross-instance cache of Gemini summaries keyed by sha256 of the extracted
+# text — versioned PDFs and resubmits are common, so repeats skip the LLM.
+SUMMARY_CACHE_COLLECTION = 'summary_cache'
+# Queue for non-interactive summarization: /upload?mode=batch drops the
+# extracted text here and an offline worker (Cloud Scheduler + Batch API)
+# writes the summary back, instead of the request waiting on Gemini.
+BATCH_QUEUE_COLLECTION = 'batch_queue'
+# Firestore ограничава документ до 1 MiB; текстът от голям PDF — точно
+# случаят за mode=batch — минава лимита, затова се реже на парчета под него.
+_QUEUE_SHARD_BYTES = 900_000
+
+def _shard_text(text: str, max_bytes: int = _QUEUE_SHARD_BYTES) -> list:
+    """Реже текста на парчета ≤ max_bytes UTF-8 байта, без да цепи знак."""
+    data = text.encode('utf-8')
+    shards, i = [], 0
+    while i < len(data):
+        j = min(i + max_bytes, len(data))
+        # Не спираме върху continuation байт (0b10xxxxxx) по средата на знак.
+        while j < len(data) and (data[j] & 0xC0) == 0x80:
+            j -= 1
+        shards.append(data[i:j].decode('utf-8'))
+        i = j
+    return shards
+
+# The dashboard refetches /documents on load and after every upload/delete;
+# a few seconds of staleness is fine, a Firestore full-collection stream per
+# refresh is not. Holds the pre-serialized JSON payload.
+_documents_cache: TTLCache = TTLCache(maxsize=1, ttl=5)
+_DOCUMENTS_CACHE_KEY = 'documents'
 
 app = FastAPI(
     title="EntaGen: Анализ на Документи",
     description="Висококачествен инструмент за анализ на корпоративни документи с Gemini 1.5 Flash и FastAPI.",
-    version="1.0.0"
+    version="1.0.0",
+    # orjson кодира отговорите няколко пъти по-бързо от стандартния json
+    default_response_class=ORJSONResponse
 )
 
+# Кирилският JSON на /documents се свива ~4x с gzip; под 1 KB компресията
+# не си струва CPU-то. Предварително компресираният "/" не се пипа повторно.
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
+def _json_default(obj):
+    """orjson hook: Firestore връща datetime подклас (DatetimeWithNanoseconds),
+    който orjson не сериализира нативно; тук го свеждаме до ISO низ.
+    str() резервният вариант поема и SERVER_TIMESTAMP sentinel-а, видим при
+    прочит непосредствено след запис, вместо заявката да гръмне с 500."""
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    return str(obj)
+
 # --- Utility Functions for Text Extraction ---
 
-async def extract_text_from_pdf(file: UploadFile) -> str:
-    """Извлича текст от PDF файл."""
+async def spool_upload_to_disk(file: UploadFile) -> tuple:
+    """Копира качения файл на порции от 1 MiB във временен файл.
+
+    Връща (път, sha256 на суровите байтове). Хешът се смята инкрементално
+    по време на копирането — без втори прочит на файла — и служи като ключ
+    за кеша на резюмета още преди извличането на текст.
+
+    Избягва `await file.read()` върху целия файл — паметта остава O(1 MiB)
+    вместо O(размер на файла), което е критично при паралелни качвания на
+    инстанции с малко RAM.
+    """
+    tmp = tempfile.NamedTemporaryFile(delete=False)
+    hasher = hashlib.sha256()
     try:
-        reader = PdfReader(io.BytesIO(await file.read()))
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() or ""
-        return text
+        while chunk := await file.read(1 << 20):
+            tmp.write(chunk)
+            hasher.update(chunk)
+    except BaseException:
+        # При грешка по време на копирането (прекъснат клиент е нормален
+        # случай) пътят така и не стига до извикващия, затова частичният
+        # файл трябва да се изтрие тук — иначе остава сирак в /tmp (tmpfs).
+        tmp.close()
+        os.unlink(tmp.name)
+        raise
+    tmp.close()
+    return tmp.name, hasher.hexdigest()
+
+# Под този брой страници IPC разходът на process pool-а надвишава печалбата.
+_PAGE_POOL_THRESHOLD = 8
+
+_page_pool = None
+
+def _get_page_pool() -> ProcessPoolExecutor:
+    global _page_pool
+    if _page_pool is None:
+        _page_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+    return _page_pool
+
+def _extract_pdf_page_range(args) -> str:
+    # Runs in a forked worker process: opens its own document handle and
+    # extracts the assigned page slice.
+    path, first, last = args
+    doc = fitz.open(path)
+    try:
+        return "\n".join(
+            doc[i].get_text("text", flags=fitz.TEXTFLAGS_TEXT)
+            for i in range(first, last)
+        )
+    finally:
+        doc.close()
+
+def _extract_pdf_sync(path: str) -> str:
+    doc = fitz.open(path)
+    try:
+        page_count = doc.page_count
+        if page_count < _PAGE_POOL_THRESHOLD:
+            # TEXTFLAGS_TEXT restricts the parser to text operators: in
+            # chart-heavy corporate decks the bulk of the content stream is
+            # vector/image operators that would otherwise be decoded for nothing.
+            return "\n".join(
+                page.get_text("text", flags=fitz.TEXTFLAGS_TEXT) for page in doc
+            )
+    finally:
+        doc.close()
+
+    # Extraction is page-parallel; split the page range across the cores so
+    # a long PDF uses the whole instance instead of one.
+    workers = min(os.cpu_count() or 1, page_count)
+    step = -(-page_count // workers)  # ceil division
+    slices = [
+        (path, first, min(first + step, page_count))
+        for first in range(0, page_count, step)
+    ]
+    return "\n".join(_get_page_pool().map(_extract_pdf_page_range, slices))
+
+_DOCX_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+_DOCX_TEXT_TAG = _DOCX_NS + 't'
+_DOCX_PARA_TAG = _DOCX_NS + 'p'
+
+def _extract_docx_sync(path: str) -> str:
+    # Walk word/document.xml directly with iterparse instead of building
+    # python-docx Document/Paragraph/Run objects just to read their text;
+    # cleared paragraph elements keep memory flat on large files.
+    parts = []
+    with zipfile.ZipFile(path) as archive, archive.open('word/document.xml') as stream:
+        for _, elem in ElementTree.iterparse(stream, events=('end',)):
+            if elem.tag == _DOCX_TEXT_TAG:
+                if elem.text:
+                    parts.append(elem.text)
+            elif elem.tag == _DOCX_PARA_TAG:
+                parts.append('\n')
+                elem.clear()
+    return ''.join(parts)
+
+# C-speed fast path: poppler's pdftotext (installed in the Docker image)
+# бие всяка Python PDF библиотека; локализира се веднъж при import.
+_PDFTOTEXT = shutil.which('pdftotext')
+
+async def extract_text_from_pdf(path: str) -> str:
+    """Извлича текст от PDF файл.
+
+    Първо опитва външния `pdftotext` (чист I/O от гледна точка на Python,
+    не товари event loop-а); при липса или грешка пада обратно към PyMuPDF
+    в worker нишка (голям PDF иначе спира всички останали заявки за секунди).
+    """
+    if _PDFTOTEXT:
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                _PDFTOTEXT, '-layout', '-enc', 'UTF-8', path, '-',
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+            stdout, _ = await proc.communicate()
+            if proc.returncode == 0:
+                return stdout.decode('utf-8', errors='replace')
+            print(f"pdftotext завърши с код {proc.returncode}; преминаване към PyMuPDF.")
+        except Exception as e:
+            print(f"Грешка при изпълнение на pdftotext: {e}; преминаване към PyMuPDF.")
+
+    try:
+        return await asyncio.to_thread(_extract_pdf_sync, path)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail=f"Неуспешно извличане на текст от PDF: {e}"
         )
 
-async def extract_text_from_docx(file: UploadFile) -> str:
-    """Извлича текст от DOCX файл."""
+async def extract_text_from_docx(path: str) -> str:
+    """Извлича текст от DOCX файл (парсва се в worker нишка)."""
     try:
-        document = DocxDocument(io.BytesIO(await file.read()))
-        text = "\n".join([paragraph.text for paragraph in document.paragraphs])
-        return text
+        return await asyncio.to_thread(_extract_docx_sync, path)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail=f"Неуспешно извличане на текст от DOCX: {e}"
         )
 
+# Екстрактор по Content-Type — една dict справка вместо низови операции и
+# if/elif по разширение на горещия път; нов формат = нов запис тук.
+MIME_DISPATCH = {
+    "application/pdf": extract_text_from_pdf,
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": extract_text_from_docx,
+}
+# Резервен dispatch по разширение, когато Content-Type липсва или е generic.
+_EXT_DISPATCH = {
+    "pdf": extract_text_from_pdf,
+    "docx": extract_text_from_docx,
+}
+
+async def _lookup_cached_summary(text_hash: str):
+    """Търси готово резюме в кеш колекцията; връща None при липса или грешка."""
+    try:
+        snapshot = await db.collection(SUMMARY_CACHE_COLLECTION).document(text_hash).get()
+        if snapshot.exists:
+            return snapshot.to_dict().get('summary')
+    except Exception as e:
+        print(f"Грешка при четене от кеша на резюмета: {e}")
+    return None
+
+async def _store_cached_summary(text_hash: str, summary: str):
+    """Записва резюме в кеш колекцията; грешките не спират отговора."""
+    try:
+        await db.collection(SUMMARY_CACHE_COLLECTION).document(text_hash).set({
+            "hash": text_hash,
+            "summary": summary,
+            "ts": firestore.SERVER_TIMESTAMP,  # allows TTL/scheduled cleanup
+        })
+    except Exception as e:
+        print(f"Грешка при запис в кеша на резюмета: {e}")
+
+# Над този размер (знаци) текстът се реже на прозорци и се обобщава map-reduce;
+# иначе дълъг PDF прави латентността и цената на заявката неограничени.
+SUMMARY_CHUNK_SIZE = 8000
+# Прегледът за списъчния изглед трябва да побира цяло резюме по промпта
+# (до 200 думи на български ≈ 1300–1600 знака); 2000 оставя резерв.
+SUMMARY_PREVIEW_CHARS = 2000
+# Едновременни Gemini извиквания при map фазата.
+_chunk_semaphore = asyncio.Semaphore(8)
+
+def _split_text(text: str, chunk_size: int = SUMMARY_CHUNK_SIZE) -> list:
+    """Разделя текста на прозорци ≤ chunk_size по граници на абзаци."""
+    if len(text) <= chunk_size:
+        return [text]
+    chunks, current, current_len = [], [], 0
+    for paragraph in text.split('\n'):
+        # Абзац, по-дълъг от прозореца, се реже твърдо.
+        while len(paragraph) > chunk_size:
+            if current:
+                chunks.append('\n'.join(current))
+                current, current_len = [], 0
+            chunks.append(paragraph[:chunk_size])
+            paragraph = paragraph[chunk_size:]
+        if current and current_len + len(paragraph) + 1 > chunk_size:
+            chunks.append('\n'.join(current))
+            current, current_len = [], 0
+        current.append(paragraph)
+        current_len += len(paragraph) + 1
+    if current:
+        chunks.append('\n'.join(current))
+    return chunks
+
+async def _generate_summary(text_content: str) -> str:
+    """Едно извикване към Gemini през batcher-а."""
+    contents = f"{SUMMARY_INSTRUCTIONS}\n\n{text_content}"
+    response = await GEMINI_BATCHER.submit(lambda: LLM_MODEL.generate_content_async(contents))
+    return response.text
+
+async def _summarize_chunk(chunk: str) -> str:
+    """Map фаза: резюме на една част, кеширано по sha256 на частта.
+
+    При повторно качване на почти същия документ повечето части съвпадат
+    и се взимат направо от кеша.
+    """
+    async with _chunk_semaphore:
+        chunk_hash = hashlib.sha256(chunk.encode('utf-8')).hexdigest()
+        part = await _lookup_cached_summary(chunk_hash)
+        if part is None:
+            part = await _generate_summary(chunk)
+            await _store_cached_summary(chunk_hash, part)
+        return part
+
 async def analyze_document_with_gemini(text_content: str) -> str:
-    """Използва Gemini 1.5 Flash за генериране на резюме."""
+    """Използва Gemini 1.5 Flash за генериране на резюме.
+
+    Преди да извика модела, проверява кеша по sha256 на извлечения текст —
+    повторно качване на същия документ връща резюмето без LLM разход.
+    Дълги документи се обобщават map-reduce: частите паралелно, после
+    финално резюме на резюметата.
+    """
+    text_hash = hashlib.sha256(text_content.encode('utf-8')).hexdigest()
+    cached_summary = await _lookup_cached_summary(text_hash)
+    if cached_summary:
+        return cached_summary
+
     try:
-        prompt = (
-            "Вие сте експерт по корпоративен анализ на документи. "
-            "Моля, резюмирайте следния документ на български език. "
-            "Обобщението трябва да е кратко, стегнато и да улавя основните точки. "
-            "Използвайте максимум 200 думи и форматирайте като списък с точки, ако е приложимо:\n\n"
-            f"{text_content}"
-        )
-        response = await LLM_MODEL.generate_content_async(prompt)
-        return response.text
+        chunks = _split_text(text_content)
+        if len(chunks) == 1:
+            summary = await _generate_summary(text_content)
+        else:
+            parts = await asyncio.gather(*(_summarize_chunk(chunk) for chunk in chunks))
+            summary = await _generate_summary(
+                "Следват резюмета на последователните части от един документ. "
+                "Обедини ги в едно цялостно резюме:\n\n" + "\n\n".join(parts)
+            )
+        await _store_cached_summary(text_hash, summary)
+        return summary
     except Exception as e:
         # Log the error for debugging
         print(f"Грешка при анализ с Gemini: {e}")
@@ -88,18 +413,28 @@ async def analyze_document_with_gemini(text_content: str) -> str:
 # --- FastAPI Endpoints ---
 
 @app.get("/", response_class=HTMLResponse)
-async def read_root():
+async def read_root(request: Request):
     """
     Основна страница на приложението EntaGen.
     Предоставя HTML интерфейс за качване и преглед на документи.
+    Съдържанието е статично — сервира се предварително кодирано (и gzip-нато)
+    от константите, изчислени при import, с Cache-Control за браузъра/CDN.
     """
-    return HTMLResponse(content=get_html_content(), status_code=status.HTTP_200_OK)
+    # Vary пази споделените кешове/CDN да не сервират gzip варианта на
+    # клиент, който не го е поискал (и обратно).
+    headers = {"Cache-Control": "public, max-age=300", "Vary": "Accept-Encoding"}
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        headers["Content-Encoding"] = "gzip"
+        return Response(content=_INDEX_HTML_GZ, media_type="text/html", headers=headers)
+    return Response(content=_INDEX_HTML, media_type="text/html", headers=headers)
 
 @app.post("/upload")
-async def upload_document(file: UploadFile = File(...)):
+async def upload_document(file: UploadFile = File(...), mode: str = "sync"):
     """
     Качва документ за анализ.
     Поддържа PDF и DOCX файлове.
+    При mode=batch документът се нарежда на опашка за нощна обработка вместо
+    заявката да чака Gemini.
     """
     if not file.filename:
         raise HTTPException(
@@ -107,38 +442,131 @@ async def upload_document(file: UploadFile = File(...)):
             detail="Не е избран файл."
         )
 
-    file_extension = file.filename.split('.')[-1].lower()
-    text_content = ""
-
-    if file_extension == "pdf":
-        text_content = await extract_text_from_pdf(file)
-    elif file_extension == "docx":
-        text_content = await extract_text_from_docx(file)
-    else:
+    # Dispatch по декларирания Content-Type; резервен вариант по разширение
+    # (покрива .PDF и клиенти, пращащи generic content type).
+    extractor = MIME_DISPATCH.get(file.content_type) \
+        or _EXT_DISPATCH.get(file.filename.rsplit('.', 1)[-1].lower())
+    if extractor is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Поддържат се само PDF и DOCX файлове."
         )
 
+    tmp_path, file_hash = await spool_upload_to_disk(file)
+
+    # Кешът по хеш на суровите байтове и извличането тръгват паралелно;
+    # чакаме първо кеша — при попадение (повторно качване на същия файл)
+    # извличането се прекратява и Gemini изобщо не се вика.
+    text_content = None
+    try:
+        cache_task = asyncio.create_task(_lookup_cached_summary(file_hash))
+        extract_task = asyncio.create_task(extractor(tmp_path))
+        cached_summary = await cache_task
+        if cached_summary is not None:
+            extract_task.cancel()
+            try:
+                await extract_task
+            except (Exception, asyncio.CancelledError):
+                pass
+        else:
+            text_content = await extract_task
+    finally:
+        os.unlink(tmp_path)
+
+    if cached_summary is not None:
+        # Резюмето е готово — записваме документа директно, включително при
+        # mode=batch: няма какво да чака нощната обработка.
+        try:
+            doc_ref = db.collection(DOCUMENTS_COLLECTION).document()
+            await doc_ref.set({
+                "name": file.filename,
+                "summary": cached_summary,
+                "summary_preview": cached_summary[:SUMMARY_PREVIEW_CHARS],
+                "status": "Анализиран",
+                "timestamp": firestore.SERVER_TIMESTAMP
+            })
+            _documents_cache.clear()
+            return ORJSONResponse(
+                status_code=status.HTTP_200_OK,
+                content={"message": "Документът е успешно качен и анализиран.", "document_id": doc_ref.id}
+            )
+        except Exception as e:
+            print(f"Грешка при запис във Firestore: {e}")
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Грешка при запазване на документа в базата данни."
+            )
+
     if not text_content.strip():
         raise HTTPException(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail="Файлът е празен или не може да бъде извлечен текст."
         )
 
+    if mode == "batch":
+        try:
+            doc_ref = db.collection(DOCUMENTS_COLLECTION).document()
+            await doc_ref.set({
+                "name": file.filename,
+                "summary": None,
+                "status": "В опашка",
+                "timestamp": firestore.SERVER_TIMESTAMP
+            })
+            # The offline worker reads the queued text, submits it through the
+            # Batch API and writes the summary back onto the document row.
+            # Texts above Firestore's 1 MiB document cap are sharded into
+            # '<id>-<n>' rows; the head row carries shard_count and is written
+            # last, so the worker never sees it before its shards exist.
+            shards = _shard_text(text_content)
+            queue = db.collection(BATCH_QUEUE_COLLECTION)
+            for first in range(0, len(shards), 10):
+                batch = db.batch()
+                for n, shard in enumerate(shards[first:first + 10], start=first):
+                    batch.set(queue.document(f"{doc_ref.id}-{n}"), {
+                        "custom_id": doc_ref.id,
+                        "shard": n,
+                        "text": shard,
+                    })
+                await batch.commit()
+            await queue.document(doc_ref.id).set({
+                "custom_id": doc_ref.id,
+                "shard_count": len(shards),
+                "status": "queued",
+                "ts": firestore.SERVER_TIMESTAMP
+            })
+            _documents_cache.clear()
+            return ORJSONResponse(
+                status_code=status.HTTP_202_ACCEPTED,
+                content={"message": "Документът е нареден на опашка за анализ.", "document_id": doc_ref.id}
+            )
+        except Exception as e:
+            print(f"Грешка при нареждане на документ в опашката: {e}")
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Грешка при нареждане на документа за анализ."
+            )
+
     summary = await analyze_document_with_gemini(text_content)
+    # Записваме резюмето и под хеша на файла — следващото качване на същите
+    # байтове ще уцели кеша още преди извличането на текст.
+    await _store_cached_summary(file_hash, summary)
 
     try:
         doc_ref = db.collection(DOCUMENTS_COLLECTION).document()
         doc_data = {
             "name": file.filename,
             "summary": summary,
+            # Преглед, записан при създаване; оразмерен да побере цяло
+            # резюме по промпта, за да може списъчната проекция един ден да
+            # мине само на него.
+            "summary_preview": summary[:SUMMARY_PREVIEW_CHARS],
             "status": "Анализиран",
             "timestamp": firestore.SERVER_TIMESTAMP # Use server timestamp for consistency
         }
         await doc_ref.set(doc_data) # Await the async set operation
+        _documents_cache.clear()
 
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=status.HTTP_200_OK,
             content={"message": "Документът е успешно качен и анализиран.", "document_id": doc_ref.id}
         )
@@ -149,23 +577,32 @@ async def upload_document(file: UploadFile = File(...)):
             detail="Грешка при запазване на документа в базата данни."
         )
 
-@app.get("/documents", response_class=JSONResponse)
+@app.get("/documents")
 async def get_documents():
     """
     Връща списък с всички анализирани документи от Firestore.
+    Резултатът се кешира за няколко секунди като готов JSON payload.
     """
+    cached_payload = _documents_cache.get(_DOCUMENTS_CACHE_KEY)
+    if cached_payload is not None:
+        return Response(content=cached_payload, media_type="application/json")
+
     try:
         documents = []
-        docs = db.collection(DOCUMENTS_COLLECTION).order_by("timestamp", direction=firestore.Query.DESCENDING).stream()
-        for doc in docs:
-            doc_data = doc.to_dict()
-            # Convert timestamp to a readable string if it exists
-            if 'timestamp' in doc_data and doc_data['timestamp']:
-                # firestore.SERVER_TIMESTAMP returns a Timestamp object
-                doc_data['timestamp'] = doc_data['timestamp'].isoformat() if hasattr(doc_data['timestamp'], 'isoformat') else str(doc_data['timestamp'])
-            
-            documents.append({"id": doc.id, **doc_data})
-        return JSONResponse(content=documents, status_code=status.HTTP_200_OK)
+        # select() праща само полетата за списъка. 'summary' остава в
+        # проекцията: редове отпреди summary_preview нямат прегледа, а
+        # dashboard-ът няма детайлен endpoint — може да отпадне, след като
+        # старите редове се backfill-нат и има маршрут за пълното резюме.
+        query = db.collection(DOCUMENTS_COLLECTION) \
+            .order_by("timestamp", direction=firestore.Query.DESCENDING) \
+            .select(["name", "status", "timestamp", "summary", "summary_preview"])
+        async for doc in query.stream():
+            documents.append({"id": doc.id, **doc.to_dict()})
+        # Timestamps (и евентуални sentinel стойности) се конвертират от
+        # _json_default вътре в C цикъла на orjson, не в Python цикъл по-горе.
+        payload = orjson.dumps(documents, default=_json_default)
+        _documents_cache[_DOCUMENTS_CACHE_KEY] = payload
+        return Response(content=payload, media_type="application/json")
     except Exception as e:
         print(f"Грешка при извличане на документи от Firestore: {e}")
         raise HTTPException(
@@ -180,13 +617,12 @@ async def delete_document(doc_id: str):
     """
     try:
         doc_ref = db.collection(DOCUMENTS_COLLECTION).document(doc_id)
-        if not (await doc_ref.get()).exists: # Check if document exists
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Документът не е намерен."
-            )
+        # Изтриването на липсващ документ е no-op за Firestore, така че
+        # предварителният get() само удвояваше латентността на всяко
+        # изтриване; операцията е идемпотентна и връща успех и в двата случая.
         await doc_ref.delete() # Await the async delete operation
-        return JSONResponse(
+        _documents_cache.clear()
+        return ORJSONResponse(
             status_code=status.HTTP_200_OK,
             content={"message": "Документът е успешно изтрит."}
         )
@@ -200,268 +636,10 @@ async def delete_document(doc_id: str):
         )
 
 # --- HTML Frontend Content ---
+# Страницата живее в templates/index.html като обикновен HTML файл — без
+# Python низ с escape-нати скоби и без повторно построяване при заявка.
+_TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
 
-def get_html_content():
-    """
-    Генерира HTML съдържанието за потребителския интерфейс.
-    Използва Tailwind CSS (CDN) за модерен Dark Mode дизайн.
-    """
-    return f"""
-<!DOCTYPE html>
-<html lang="bg" class="dark">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>EntaGen: Анализ на Документи</title>
-    <!-- Tailwind CSS CDN -->
-    <script src="https://cdn.tailwindcss.com"></script>
-    <style>
-        /* Dark Mode configuration for Tailwind CSS */
-        :root {{
-            --color-primary: #1a73e8; /* Google Blue */
-            --color-danger: #ea4335; /* Google Red */
-        }}
-        .dark {{
-            color-scheme: dark;
-        }}
-        .dark body {{
-            background-color: #1a202c; /* Dark Gray */
-            color: #e2e8f0; /* Light Gray */
-        }}
-        .dark .bg-white {{
-            background-color: #2d3748; /* Darker Gray */
-        }}
-        .dark .text-gray-700 {{
-            color: #cbd5e0; /* Lighter Gray */
-        }}
-        .dark .border-gray-300 {{
-            border-color: #4a5568; /* Gray Border */
-        }}
-        .dark .hover\\:bg-gray-50 {{
-            background-color: #4a5568; /* Darker Gray on hover */
-        }}
-        /* Custom drag-and-drop styles */
-        .drag-area {{
-            border: 2px dashed #4a5568;
-            background-color: #2d3748;
-            transition: background-color 0.3s ease;
-        }}
-        .drag-area.highlight {{
-            background-color: #4a5568;
-            border-color: var(--color-primary);
-        }}
-        .upload-button {{
-            background-color: var(--color-primary);
-        }}
-        .upload-button:hover {{
-            background-color: #1558b3;
-        }}
-        .delete-button {{
-            background-color: var(--color-danger);
-        }}
-        .delete-button:hover {{
-            background-color: #d12a1c;
-        }}
-        .spinner {{
-            border: 4px solid rgba(255, 255, 255, 0.3);
-            border-top: 4px solid var(--color-primary);
-            border-radius: 50%;
-            width: 30px;
-            height: 30px;
-            animation: spin 1s linear infinite;
-        }}
-        @keyframes spin {{
-            0% {{ transform: rotate(0deg); }}
-            100% {{ transform: rotate(360deg); }}
-        }}
-    </style>
-</head>
-<body class="bg-gray-900 text-gray-100 font-sans leading-normal tracking-normal p-4">
-
-    <div class="container mx-auto p-4 bg-gray-800 shadow-xl rounded-lg mt-8 max-w-4xl">
-        <h1 class="text-4xl font-bold text-center mb-8 text-white">EntaGen: Анализ на Документи</h1>
-
-        <!-- File Upload Section -->
-        <div class="mb-8 p-6 bg-gray-700 rounded-lg shadow-md">
-            <h2 class="text-2xl font-semibold mb-4 text-white">Качване на Документ</h2>
-            <div id="drag-area" class="drag-area flex flex-col items-center justify-center p-10 text-center rounded-lg cursor-pointer transition-all duration-300 ease-in-out hover:border-blue-500 hover:bg-gray-600">
-                <input type="file" id="fileInput" accept=".pdf,.docx" multiple class="hidden">
-                <svg class="w-16 h-16 text-gray-400 mb-3" fill="none" stroke="currentColor" viewBox="0 0 24 24" xmlns="http://www.w3.org/2000/svg"><path stroke-linecap="round" stroke-linejoin="round" stroke-width="2" d="M7 16a4 4 0 01-.88-7.903A5 5 0 0115.9 6L16 6a5 5 0 011 9.9M15 13l-3-3m0 0l-3 3m3-3v12"></path></svg>
-                <p class="text-lg text-gray-300">Плъзнете и пуснете файлове тук или <span class="text-blue-400 font-medium hover:underline">кликнете за избор</span></p>
-                <p class="text-sm text-gray-400 mt-1">(Поддържат се .pdf и .docx файлове)</p>
-                <div id="fileListPreview" class="mt-4 w-full text-left text-gray-300"></div>
-            </div>
-            <div id="uploadStatus" class="mt-4 text-center font-medium"></div>
-            <div id="loadingSpinner" class="hidden mt-4 flex justify-center">
-                <div class="spinner"></div>
-            </div>
-        </div>
-
-        <!-- Document List Section -->
-        <div class="p-6 bg-gray-700 rounded-lg shadow-md">
-            <h2 class="text-2xl font-semibold mb-4 text-white">Анализирани Документи</h2>
-            <div id="documentsList" class="space-y-4">
-                <p id="noDocumentsMessage" class="text-gray-400 text-center">Няма анализирани документи.</p>
-                <!-- Documents will be loaded here by JavaScript -->
-            </div>
-        </div>
-    </div>
-
-    <script>
-        const dragArea = document.getElementById('drag-area');
-        const fileInput = document.getElementById('fileInput');
-        const fileListPreview = document.getElementById('fileListPreview');
-        const uploadStatus = document.getElementById('uploadStatus');
-        const loadingSpinner = document.getElementById('loadingSpinner');
-        const documentsList = document.getElementById('documentsList');
-        const noDocumentsMessage = document.getElementById('noDocumentsMessage');
-
-        // --- Drag and Drop Handlers ---
-        dragArea.addEventListener('click', () => fileInput.click());
-        fileInput.addEventListener('change', (e) => handleFiles(e.target.files));
-
-        dragArea.addEventListener('dragover', (e) => {
-            e.preventDefault();
-            dragArea.classList.add('highlight');
-        });
-        dragArea.addEventListener('dragleave', () => {
-            dragArea.classList.remove('highlight');
-        });
-        dragArea.addEventListener('drop', (e) => {
-            e.preventDefault();
-            dragArea.classList.remove('highlight');
-            handleFiles(e.dataTransfer.files);
-        });
-
-        // --- File Handling and Upload ---
-        async function handleFiles(files) {
-            fileListPreview.innerHTML = ''; // Clear previous previews
-            uploadStatus.textContent = '';
-            loadingSpinner.classList.remove('hidden');
-
-            if (files.length === 0) {
-                loadingSpinner.classList.add('hidden');
-                return;
-            }
-
-            for (const file of files) {
-                const li = document.createElement('div');
-                li.className = 'flex items-center justify-between p-2 bg-gray-600 rounded-md mb-2';
-                li.innerHTML = `
-                    <span class="text-gray-200">${file.name}</span>
-                    <span class="text-gray-400 text-sm">Качване...</span>
-                `;
-                fileListPreview.appendChild(li);
-
-                if (!['application/pdf', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'].includes(file.type)) {
-                    li.children[1].textContent = 'Неподдържан формат';
-                    li.children[1].className = 'text-red-400 text-sm';
-                    continue; // Skip unsupported files
-                }
-
-                const formData = new FormData();
-                formData.append('file', file);
-
-                try {
-                    const response = await fetch('/upload', {
-                        method: 'POST',
-                        body: formData,
-                    });
-                    const data = await response.json();
-
-                    if (response.ok) {
-                        li.children[1].textContent = 'Успешно анализиран!';
-                        li.children[1].className = 'text-green-400 text-sm';
-                        fetchDocuments(); // Refresh the list after successful upload
-                    } else {
-                        li.children[1].textContent = `Грешка: ${data.detail || 'Неизвестна грешка'}`;
-                        li.children[1].className = 'text-red-400 text-sm';
-                    }
-                } catch (error) {
-                    console.error('Upload error:', error);
-                    li.children[1].textContent = 'Грешка в мрежата или сървъра.';
-                    li.children[1].className = 'text-red-400 text-sm';
-                }
-            }
-            loadingSpinner.classList.add('hidden');
-        }
-
-        // --- Document List Management ---
-        async function fetchDocuments() {
-            loadingSpinner.classList.remove('hidden');
-            documentsList.innerHTML = ''; // Clear current list
-            try {
-                const response = await fetch('/documents');
-                const documents = await response.json();
-
-                if (documents.length === 0) {
-                    noDocumentsMessage.classList.remove('hidden');
-                } else {
-                    noDocumentsMessage.classList.add('hidden');
-                    documents.forEach(doc => {
-                        const docElement = document.createElement('div');
-                        docElement.id = `doc-${doc.id}`;
-                        docElement.className = 'bg-gray-800 p-4 rounded-lg shadow-md border border-gray-600 flex flex-col md:flex-row md:items-start justify-between gap-4';
-                        
-                        const timestamp = doc.timestamp ? new Date(doc.timestamp).toLocaleString('bg-BG') : 'Неизвестна дата';
-
-                        docElement.innerHTML = `
-                            <div class="flex-grow">
-                                <h3 class="text-xl font-semibold text-white mb-2">${doc.name}</h3>
-                                <p class="text-gray-300 text-sm mb-1">Статус: <span class="text-green-400">${doc.status}</span></p>
-                                <p class="text-gray-400 text-xs mb-3">Качено на: ${timestamp}</p>
-                                <div class="bg-gray-700 p-3 rounded-md text-gray-200 text-sm leading-relaxed max-h-48 overflow-y-auto">
-                                    <h4 class="font-medium text-white mb-1">Резюме:</h4>
-                                    <p>${doc.summary || 'Няма налично резюме.'}</p>
-                                </div>
-                            </div>
-                            <div class="flex-shrink-0 mt-4 md:mt-0">
-                                <button onclick="deleteDocument('${doc.id}')" class="delete-button text-white px-4 py-2 rounded-md transition-colors duration-200 text-sm">
-                                    Изтрий
-                                </button>
-                            </div>
-                        `;
-                        documentsList.appendChild(docElement);
-                    });
-                }
-            } catch (error) {
-                console.error('Error fetching documents:', error);
-                documentsList.innerHTML = `<p class="text-red-400 text-center">Грешка при зареждане на документи.</p>`;
-                noDocumentsMessage.classList.add('hidden'); // Hide if there's an error message
-            } finally {
-                loadingSpinner.classList.add('hidden');
-            }
-        }
-
-        async function deleteDocument(docId) {
-            if (!confirm('Сигурни ли сте, че искате да изтриете този документ?')) {
-                return;
-            }
-
-            loadingSpinner.classList.remove('hidden');
-            try {
-                const response = await fetch(`/documents/${docId}`, {
-                    method: 'DELETE',
-                });
-                const data = await response.json();
-
-                if (response.ok) {
-                    alert(data.message);
-                    fetchDocuments(); // Refresh the list
-                } else {
-                    alert(`Грешка при изтриване: ${data.detail || 'Неизвестна грешка'}`);
-                }
-            } catch (error) {
-                console.error('Delete error:', error);
-                alert('Грешка в мрежата или сървъра при изтриване.');
-            } finally {
-                loadingSpinner.classList.add('hidden');
-            }
-        }
-
-        // --- Initial Load ---
-        document.addEventListener('DOMContentLoaded', fetchDocuments);
-    </script>
-</body>
-</html>
-    """
+with open(os.path.join(_TEMPLATES_DIR, "index.html"), "rb") as _f:
+    _INDEX_HTML: bytes = _f.read()
+_INDEX_HTML_GZ: bytes = gzip.compress(_INDEX_HTML, 9)